@@ -4,13 +4,66 @@ API 自动化测试
 测试 OpCode API Server 的 REST API 接口
 """
 
-import json
+import functools
+import hashlib
+import http.client
+import os
 import sys
 import time
-import urllib.request
 import urllib.parse
-import urllib.error
-from typing import Dict, Any, Optional, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, Optional, List, Callable, Union
+
+from common import (
+    REPLAY_ENABLED, BufferedStdout, ConnectionPool, do_http,
+    json_dumps, json_loads, replay_dir,
+)
+
+# 固定不变的请求体，在模块加载时一次性序列化
+_TEST_AGENT_BODY = json_dumps({
+    "name": "test-agent",
+    "description": "测试用agent",
+    "type": "system",
+    "config": {"test": True}
+})
+
+# OPCODE_TEST_REPLAY=1 时，GET 响应会缓存到磁盘，之后的运行直接回放
+_REPLAY_DIR = replay_dir('api_replay')
+_REPLAY_METHODS = frozenset(['GET'])
+
+
+def _replay_cached(func: Callable) -> Callable:
+    """为 _make_request 增加按 (method, url, body) 键控的磁盘回放缓存"""
+    @functools.wraps(func)
+    def wrapper(self, method: str, endpoint: str, data: Optional[Union[Dict, bytes]] = None,
+                headers: Optional[Dict] = None) -> tuple:
+        if not REPLAY_ENABLED or method not in _REPLAY_METHODS:
+            return func(self, method, endpoint, data, headers)
+            
+        key = repr((
+            method,
+            f"{self.base_url}{endpoint}",
+            sorted(data.items()) if isinstance(data, dict) else data,
+            sorted(headers.items()) if headers else None,
+        ))
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+        path = os.path.join(_REPLAY_DIR, f"{digest}.json")
+        
+        try:
+            with open(path, 'rb') as f:
+                status, response = json_loads(f.read())
+            return status, response
+        except (OSError, ValueError):
+            pass
+            
+        status, response = func(self, method, endpoint, data, headers)
+        if status:  # 连接失败（状态码0）不缓存
+            os.makedirs(_REPLAY_DIR, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(json_dumps([status, response]))
+        return status, response
+        
+    return wrapper
 
 
 class APITester:
@@ -18,34 +71,24 @@ class APITester:
         self.base_url = base_url.rstrip('/')
         self.session_headers = {'Content-Type': 'application/json'}
         
-    def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None, 
+        # 每个线程复用一条 keep-alive 连接，避免每次请求都重新建立TCP连接
+        parsed = urllib.parse.urlsplit(self.base_url)
+        conn_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self._pool = ConnectionPool(functools.partial(conn_class, parsed.hostname, parsed.port))
+        self._path_prefix = parsed.path
+        
+    def close(self):
+        """关闭所有线程复用的HTTP连接"""
+        self._pool.close()
+        
+    @_replay_cached
+    def _make_request(self, method: str, endpoint: str, data: Optional[Union[Dict, bytes]] = None, 
                      headers: Optional[Dict] = None) -> tuple:
         """发送HTTP请求并返回响应"""
-        url = f"{self.base_url}{endpoint}"
-        req_headers = self.session_headers.copy()
+        req_headers = self.session_headers
         if headers:
-            req_headers.update(headers)
-            
-        req_data = None
-        if data:
-            req_data = json.dumps(data).encode('utf-8')
-            
-        try:
-            request = urllib.request.Request(url, data=req_data, headers=req_headers, method=method)
-            with urllib.request.urlopen(request) as response:
-                response_data = response.read().decode('utf-8')
-                try:
-                    return response.status, json.loads(response_data) if response_data else {}
-                except json.JSONDecodeError:
-                    return response.status, response_data
-        except urllib.error.HTTPError as e:
-            error_data = e.read().decode('utf-8')
-            try:
-                return e.code, json.loads(error_data) if error_data else {}
-            except json.JSONDecodeError:
-                return e.code, error_data
-        except Exception as e:
-            return 0, {'error': str(e)}
+            req_headers = {**self.session_headers, **headers}
+        return do_http(self._pool.get(), method, f"{self._path_prefix}{endpoint}", data, req_headers)
 
     def test_health_check(self) -> bool:
         """测试健康检查接口"""
@@ -75,13 +118,7 @@ class APITester:
         print(f"  列出agents: {'✓' if success else '✗'} ({status})")
         
         # 测试创建agent
-        test_agent = {
-            "name": "test-agent",
-            "description": "测试用agent",
-            "type": "system",
-            "config": {"test": True}
-        }
-        status, response = self._make_request('POST', '/api/agents', test_agent)
+        status, response = self._make_request('POST', '/api/agents', _TEST_AGENT_BODY)
         success = status in [200, 201, 400, 422]  # 可能的有效响应
         results.append(success)
         print(f"  创建agent: {'✓' if success else '✗'} ({status})")
@@ -173,14 +210,7 @@ class APITester:
         print(f"  Agent不存在错误: {'✓' if success else '✗'} ({status})")
         
         # 测试无效JSON
-        try:
-            url = f"{self.base_url}/api/agents"
-            req_headers = {'Content-Type': 'application/json'}
-            request = urllib.request.Request(url, data=b'invalid json', headers=req_headers, method='POST')
-            with urllib.request.urlopen(request) as response:
-                status = response.status
-        except urllib.error.HTTPError as e:
-            status = e.code
+        status, response = self._make_request('POST', '/api/agents', b'invalid json')
         
         success = status == 400
         results.append(success)
@@ -202,15 +232,24 @@ class APITester:
             ("错误处理", self.test_error_handling),
         ]
         
+        # 各测试相互独立且以网络等待为主，并发执行；输出按测试缓冲，完成后整体打印
         results = []
-        for name, test_func in tests:
-            try:
-                result = test_func()
-                results.append(result)
-                print(f"{name}: {'✓ 通过' if result else '✗ 失败'}\n")
-            except Exception as e:
-                print(f"{name}: ✗ 异常 - {e}\n")
-                results.append(False)
+        stdout = BufferedStdout(sys.stdout)
+        sys.stdout = stdout
+        try:
+            with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+                futures = {executor.submit(stdout.run, test_func): name for name, test_func in tests}
+                for future in as_completed(futures):
+                    name = futures[future]
+                    output, result, error = future.result()
+                    print(output, end='')
+                    if error is None:
+                        print(f"{name}: {'✓ 通过' if result else '✗ 失败'}\n")
+                    else:
+                        print(f"{name}: ✗ 异常 - {error}\n")
+                    results.append(bool(result))
+        finally:
+            sys.stdout = stdout.stream
         
         passed = sum(results)
         total = len(results)
@@ -248,7 +287,10 @@ def main():
         sys.exit(1)
     
     # 运行测试
-    success = tester.run_all_tests()
+    try:
+        success = tester.run_all_tests()
+    finally:
+        tester.close()
     sys.exit(0 if success else 1)
 
 
@@ -0,0 +1,131 @@
+"""
+测试公共工具
+api_tests.py 与 websocket_tests.py 共用的 JSON 编解码、HTTP 请求、录制回放设置与输出缓冲
+"""
+
+import http.client
+import io
+import json
+import os
+import threading
+from typing import Dict, Any, Optional, Callable, Union
+
+# 优先使用 orjson（编解码更快），未安装时回退到标准库 json
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+    JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    json_loads = json.loads
+    JSONDecodeError = json.JSONDecodeError
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# OPCODE_TEST_REPLAY=1 时两个测试脚本都启用录制/回放，录制文件统一放在当前目录的 .cache 下
+REPLAY_ENABLED = os.environ.get('OPCODE_TEST_REPLAY') == '1'
+REPLAY_CACHE_ROOT = '.cache'
+
+
+def replay_dir(name: str) -> str:
+    """某一类录制文件所在的目录"""
+    return os.path.join(REPLAY_CACHE_ROOT, name)
+
+
+class ConnectionPool:
+    """按线程复用 keep-alive 连接，并发测试时各线程互不争用"""
+
+    def __init__(self, factory: Callable[[], http.client.HTTPConnection]):
+        self._factory = factory
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def get(self) -> http.client.HTTPConnection:
+        """获取当前线程专用的连接，首次调用时创建"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._factory()
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def close(self):
+        """关闭所有线程创建的连接"""
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+
+
+def _send(conn: http.client.HTTPConnection, method: str, path: str,
+          body: Optional[bytes], headers: Dict) -> tuple:
+    """在复用连接上发送请求，连接被服务器关闭时重连重试一次"""
+    for attempt in range(2):
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        except ConnectionError:
+            conn.close()
+            if attempt:
+                raise
+
+
+def do_http(conn: http.client.HTTPConnection, method: str, path: str,
+            data: Optional[Union[Dict, bytes]] = None, headers: Optional[Dict] = None,
+            _dumps=json_dumps, _loads=json_loads, _decode_error=JSONDecodeError) -> tuple:
+    """发送HTTP请求并返回 (状态码, 响应)
+
+    data 为已序列化的 bytes 时原样发送，否则编码为JSON；响应优先按JSON解析，
+    解析失败时返回文本。连接失败时状态码为0。
+    末尾的默认参数把常用的全局函数绑定为局部变量，减少每次调用的查找开销。
+    """
+    body = None
+    if isinstance(data, (bytes, bytearray)):
+        body = data
+    elif data:
+        body = _dumps(data)
+
+    try:
+        status, response_data = _send(conn, method, path, body, headers or JSON_HEADERS)
+    except Exception as e:
+        conn.close()
+        return 0, {'error': str(e)}
+
+    try:
+        return status, _loads(response_data) if response_data else {}
+    except (ValueError, _decode_error):
+        return status, response_data.decode('utf-8', 'replace')
+
+
+class BufferedStdout:
+    """线程感知的 stdout 代理：通过 run() 执行的函数，其输出写入该线程独立的缓冲区"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self._local, 'buffer', None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def run(self, func: Callable[[], bool]) -> tuple:
+        """运行测试函数，返回 (缓冲的输出, 结果, 异常)"""
+        self._local.buffer = io.StringIO()
+        try:
+            try:
+                result, error = func(), None
+            except Exception as e:
+                result, error = False, e
+            return self._local.buffer.getvalue(), result, error
+        finally:
+            self._local.buffer = None